@@ -1,28 +1,51 @@
 import asyncio
+import atexit
 import datetime
-import json
+import heapq
+import html
 import logging
+import logging.handlers
 import os
+import queue
 import random
+import signal
 import time
+from collections import deque
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Dict, List
+from typing import Dict, List, Optional, Sequence, Set, Tuple
 
+import orjson
+from aiohttp import web
+from aiolimiter import AsyncLimiter
 from aiogram import Bot, Dispatcher, types
+from aiogram.client.session.aiohttp import AiohttpSession
 from aiogram.filters import Command
+from aiogram.methods import SendMessage, SendPhoto
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
 from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
     Message,
     CallbackQuery,
     ChatMemberUpdated,
+    ErrorEvent,
+    FSInputFile,
 )
 from aiogram.enums import ChatType
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramAPIError, TelegramUnauthorizedError
 
 import config
-
-logging.basicConfig(level=logging.INFO)
+from health_check import make_health_handler, start_health_server
+
+# Записи логов уходят в очередь, а в stdout их пишет отдельный поток,
+# чтобы обработчики (например, при ошибках рассылки ЛС) не ждали вывода
+LOG_QUEUE = queue.SimpleQueue()
+LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, logging.StreamHandler())
+logging.basicConfig(level=logging.INFO, handlers=[logging.handlers.QueueHandler(LOG_QUEUE)])
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
 logger = logging.getLogger(__name__)
 
 # Проверяем наличие токена
@@ -30,90 +53,258 @@ if not config.TOKEN:
     logger.error("Токен бота не найден! Создайте файл .env с BOT_TOKEN=your_token_here")
     exit(1)
 
-bot = Bot(token=config.TOKEN)
+# Одна сессия с пулом соединений к api.telegram.org. keep-alive держим дольше
+# стандартных 15 с, чтобы рассылки ЛС между раундами не открывали новые TLS-соединения
+session = AiohttpSession()
+session._connector_init["keepalive_timeout"] = 75
+bot = Bot(token=config.TOKEN, session=session)
 dp = Dispatcher()
 
+# Ограничитель исходящих сообщений, чтобы не упираться в 429 от Telegram
+SEND_LIMITER = AsyncLimiter(25, 1)
+
+@session.middleware()
+async def limit_sends(make_request, client, method):
+    """Пропускает через SEND_LIMITER все отправки: send(), message.reply(), send_photo()"""
+    if isinstance(method, (SendMessage, SendPhoto)):
+        async with SEND_LIMITER:
+            return await make_request(client, method)
+    return await make_request(client, method)
+
+# Время последнего успешного запроса к Telegram API. В режиме polling getUpdates
+# завершается не реже чем раз в polling_timeout, поэтому долгая тишина значит, что бот не работает
+LAST_API_SUCCESS = time.monotonic()
+HEALTH_MAX_SILENCE = 120  # секунд без успешных запросов, после которых /health отвечает 503
+
+@session.middleware()
+async def track_api_success(make_request, client, method):
+    global LAST_API_SUCCESS
+    result = await make_request(client, method)
+    LAST_API_SUCCESS = time.monotonic()
+    return result
+
+def bot_is_alive() -> bool:
+    return time.monotonic() - LAST_API_SUCCESS < HEALTH_MAX_SILENCE
+
 # --- Загрузка данных ---
 DATA_DIR = Path(config.DATA_DIR)
 SITUATIONS_FILE = DATA_DIR / "situations.json"
 WITNESSES_FILE = DATA_DIR / "witnesses.json"
-CONCLUSIONS_FILE = DATA_DIR / "conclusions.json"
 
 def load_json(path):
+    # Данные только читаются, поэтому храним их неизменяемыми кортежами
     if not path.exists():
-        return []
-    return json.loads(path.read_text(encoding="utf-8"))
+        return ()
+    return tuple(orjson.loads(path.read_bytes()))
+
+@dataclass(slots=True, frozen=True)
+class Situation:
+    """Карта ситуации из situations.json"""
+    title: str = "Ситуация"
+    text: str = ""
+    article: str = ""
+    consequence: str = ""
+
+@dataclass(slots=True, frozen=True)
+class Witness:
+    """Карта свидетеля из witnesses.json"""
+    title: str = "Карта свидетеля"
+    text: str = ""
+
+# Записи приводим к dataclass'ам при загрузке: лишние или опечатанные ключи
+# обнаружатся сразу при старте, а не во время игры
+SITUATIONS = tuple(Situation(**s) for s in load_json(SITUATIONS_FILE))
+WITNESSES = tuple(Witness(**w) for w in load_json(WITNESSES_FILE))
+
+# Тексты ситуаций и карт свидетелей рендерим один раз, чтобы не собирать их в каждом раунде
+SITUATIONS_RENDERED = tuple(
+    f"<b>СИТУАЦИЯ:</b> {s.title}\n\n{s.text}\n\n{s.article}\n\n{s.consequence}"
+    for s in SITUATIONS
+)
+WITNESSES_RENDERED = tuple(
+    f"Ваша кураторская карта свидетеля:\n\n<b>{w.title}</b>\n\n{w.text}"
+    for w in WITNESSES
+)
 
-SITUATIONS = load_json(SITUATIONS_FILE)
-WITNESSES = load_json(WITNESSES_FILE)
-CONCLUSIONS = load_json(CONCLUSIONS_FILE)
+# Картинка с инструкцией: проверяем наличие один раз при запуске
+INSTRUCTIONS_PATH = Path("./instructions.jpg")
+INSTRUCTIONS_FILE = FSInputFile(INSTRUCTIONS_PATH) if INSTRUCTIONS_PATH.exists() else None
+# file_id картинки после первой загрузки — дальше отправляем по нему, без повторного upload
+INSTRUCTIONS_FILE_ID: Optional[str] = None
 
 # --- Константы для очистки ---
 GAME_TIMEOUT = 3600  # 1 час в секундах
-CLEANUP_INTERVAL = 300  # 5 минут в секундах
+
+HEARTBEAT_INTERVAL = 1800  # проверка соединения с Telegram API каждые 30 минут
+HEARTBEAT_LOG_EVERY = 2  # heartbeat в лог — на каждой второй проверке (раз в час)
+
+JOIN_FLUSH_DELAY = 1.0  # окно (сек), за которое входы игроков объединяются в одно сообщение
+
+# --- Сохранение состояния игр между перезапусками ---
+GAMES_FILE = DATA_DIR / "games.json"
+GAMES_SAVE_DELAY = 5.0  # изменения за это окно (сек) записываются на диск одной записью
 
 # --- Хранилище состояний игр в разных чатах (in-memory) ---
-# Структура для каждого chat_id:
-# {
-#   "players": {user_id: {"name": str, "role": str, "is_joined": True}},
-#   "order": [user_id, ...],  # порядок игроков
-#   "roles_assigned": bool,
-#   "current_situation": {title, text},
-#   "used_situations": set(),
-#   "used_witnesses": set(),
-#   "stage": "idle"/"situation"/"witnesses"/"debate"/"verdict",
-#   "judge_id": user_id,
-#   "defendant_id": user_id,
-#   "witness_map": {user_id: witness_text},
-#   "last_activity": timestamp,  # время последней активности
-# }
-GAMES: Dict[int, Dict] = {}
-GAMES_LOCK = asyncio.Lock()
+@dataclass(slots=True)
+class Player:
+    """Участник игры; упоминание форматируется один раз при входе"""
+    name: str
+    mention: str  # готовая HTML-ссылка на пользователя
+    role: Optional[str] = None
+
+@dataclass(slots=True)
+class Game:
+    """Состояние игры в одном чате"""
+    players: Dict[int, Player] = field(default_factory=dict)  # {user_id: Player}
+    order: List[int] = field(default_factory=list)  # порядок игроков
+    roles_assigned: bool = False
+    current_situation: Optional[str] = None  # готовый HTML-текст ситуации
+    situation_deck: List[int] = field(default_factory=list)  # перемешанные индексы ещё не выпавших ситуаций
+    witness_deck: List[int] = field(default_factory=list)  # перемешанные индексы ещё не выпавших карт свидетелей
+    stage: str = "joining"  # "joining"/"situation"/"debate"/"verdict"/"finished"
+    judge_id: Optional[int] = None
+    defendant_id: Optional[int] = None
+    witnesses_drawn: Set[int] = field(default_factory=set)  # кто уже вытянул карту в этом раунде
+    roles_announcement: Optional[str] = None  # готовое HTML-объявление ролей
+    status_text: Optional[str] = None  # кэш ответа /status, сбрасывается при изменении игроков/ролей
+    pending_joins: List[str] = field(default_factory=list)  # упоминания ещё не объявленных игроков
+    join_flush_task: Optional[asyncio.Task] = None  # отложенное объявление о входе игроков
+    last_activity: float = field(default_factory=time.monotonic)  # время последней активности (time.monotonic)
+
+GAMES: Dict[int, Game] = {}
+# Сигнал для persist_games_task, что GAMES изменились и их нужно записать на диск
+GAMES_DIRTY = asyncio.Event()
+# Куча (время_истечения, chat_id) для очистки неактивных игр без полного обхода GAMES
+EXPIRY_HEAP: List[Tuple[float, int]] = []
+# Сигнал для cleanup_task, что в куче появилась более ранняя запись
+CLEANUP_WAKE = asyncio.Event()
+# Отдельный lock на каждый чат, чтобы независимые игры не блокировали друг друга
+GAME_LOCKS: Dict[int, asyncio.Lock] = {}
+
+def game_lock(chat_id: int) -> asyncio.Lock:
+    """Возвращает lock игры в чате (создаёт при первом обращении)"""
+    lock = GAME_LOCKS.get(chat_id)
+    if lock is None:
+        lock = GAME_LOCKS[chat_id] = asyncio.Lock()
+    return lock
+
+def drop_game_lock(chat_id: int):
+    """Удаляет lock завершённой игры, если его никто не держит"""
+    lock = GAME_LOCKS.get(chat_id)
+    if lock is not None and not lock.locked():
+        del GAME_LOCKS[chat_id]
+
+# Кэш администраторов чатов: {chat_id: (время_загрузки, {user_id, ...})}
+ADMIN_CACHE: Dict[int, Tuple[float, Set[int]]] = {}
+ADMIN_CACHE_TTL = 60  # секунд
+
+# Фоновые отправки сообщений (см. send_later)
+PENDING_SENDS: Set[asyncio.Task] = set()
+
+# Роли раздаются по порядку: BASE_ROLES[0] — судья, BASE_ROLES[3] — подсудимый
+BASE_ROLES = ("Судья", "Прокурор", "Адвокат", "Подсудимый")
 
 # --- Утилиты ---
-def pick_random_and_mark(collection: List, used: set):
+def new_deck(size: int) -> List[int]:
+    """Перемешанная колода индексов 0..size-1"""
+    return random.sample(range(size), size)
+
+def draw_random(collection: Sequence, deck: List[int]):
+    """Вытягивает следующий элемент из перемешанной колоды без повторов за O(1)"""
     if not collection:
         return None
-    available = [i for i in range(len(collection)) if i not in used]
-    if not available:
-        # reset used
-        used.clear()
-        available = list(range(len(collection)))
-    idx = random.choice(available)
-    used.add(idx)
-    return collection[idx]
+    if not deck:
+        # колода закончилась — перемешиваем заново
+        deck[:] = new_deck(len(collection))
+    return collection[deck.pop()]
+
+async def send(*args, **kwargs):
+    """Сокращение для bot.send_message (ограничение частоты — в middleware limit_sends, для всех запросов)"""
+    return await bot.send_message(*args, **kwargs)
+
+def _send_done(task: asyncio.Task):
+    PENDING_SENDS.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.warning(f"Не удалось отправить сообщение: {task.exception()}")
+
+def send_later(*args, **kwargs):
+    """send() в фоне — для сообщений, результат которых не нужен; обработчик не ждёт ответа Telegram"""
+    task = asyncio.create_task(send(*args, **kwargs))
+    PENDING_SENDS.add(task)  # держим ссылку, чтобы задачу не собрал GC
+    task.add_done_callback(_send_done)
+
+async def is_admin(chat_id: int, user_id: int) -> bool:
+    """Проверяет, что пользователь — админ чата (список админов кэшируется на ADMIN_CACHE_TTL)"""
+    entry = ADMIN_CACHE.get(chat_id)
+    if entry and time.monotonic() - entry[0] < ADMIN_CACHE_TTL:
+        return user_id in entry[1]
+    admins = await bot.get_chat_administrators(chat_id)
+    ids = {admin.user.id for admin in admins}
+    ADMIN_CACHE[chat_id] = (time.monotonic(), ids)
+    return user_id in ids
 
 def get_mention(user: types.User):
-    name = user.full_name
+    name = html.escape(user.full_name)
     return f"<a href='tg://user?id={user.id}'>{name}</a>"
 
+async def flush_joins(chat_id: int):
+    """Объявляет одним сообщением всех, кто присоединился за последние JOIN_FLUSH_DELAY секунд"""
+    await asyncio.sleep(JOIN_FLUSH_DELAY)
+    # игру могли завершить за время паузы — тогда не создаём для чата новый lock
+    if chat_id not in GAMES:
+        return
+    async with game_lock(chat_id):
+        game = GAMES.get(chat_id)
+        if not game:
+            return
+        mentions = game.pending_joins
+        game.pending_joins = []
+        game.join_flush_task = None
+
+    if not mentions:
+        return
+    if len(mentions) == 1:
+        text = f"{mentions[0]} присоединился к игре."
+    else:
+        text = "К игре присоединились: " + ", ".join(mentions)
+    try:
+        await send(chat_id, text, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.error(f"Ошибка при объявлении новых игроков в чате {chat_id}: {e}")
+
 # --- Функции очистки ---
 async def cleanup_old_games():
     """Очищает игры, которые неактивны более GAME_TIMEOUT секунд"""
-    current_time = time.time()
+    current_time = time.monotonic()
     removed_games = []
-    
-    async with GAMES_LOCK:
-        games_to_remove = []
-        for chat_id, game in GAMES.items():
-            last_activity = game.get('last_activity', current_time)
-            if current_time - last_activity > GAME_TIMEOUT:
-                games_to_remove.append(chat_id)
-                removed_games.append(chat_id)
-        
-        for chat_id in games_to_remove:
+
+    # Достаём из кучи только истёкшие записи, а не обходим все игры.
+    # Устаревшие записи (игра с тех пор была активна или уже удалена) просто отбрасываются.
+    while EXPIRY_HEAP and EXPIRY_HEAP[0][0] <= current_time:
+        _, chat_id = heapq.heappop(EXPIRY_HEAP)
+        game = GAMES.get(chat_id)
+        if game is not None and current_time - game.last_activity >= GAME_TIMEOUT:
             del GAMES[chat_id]
-    
+            drop_game_lock(chat_id)
+            removed_games.append(chat_id)
+
     if removed_games:
+        GAMES_DIRTY.set()
         logger.info(f"Очищено {len(removed_games)} неактивных игр: {removed_games}")
     
     return len(removed_games)
 
 async def cleanup_task():
-    """Периодическая задача очистки неиспользуемых игр"""
+    """Фоновая задача очистки: спит до ближайшего истечения игры в EXPIRY_HEAP"""
     while True:
         try:
-            await asyncio.sleep(CLEANUP_INTERVAL)
+            # Если игр нет — ждём, пока update_game_activity не разбудит задачу
+            timeout = max(1.0, EXPIRY_HEAP[0][0] - time.monotonic()) if EXPIRY_HEAP else None
+            try:
+                await asyncio.wait_for(CLEANUP_WAKE.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            CLEANUP_WAKE.clear()
             try:
                 removed_count = await cleanup_old_games()
                 if removed_count > 0:
@@ -130,20 +321,24 @@ async def cleanup_task():
             await asyncio.sleep(60)
 
 async def heartbeat_task(start_time: datetime.datetime):
-    """Периодическая задача для поддержания активности бота"""
+    """Проверяет соединение с Telegram API каждые HEARTBEAT_INTERVAL секунд
+    и раз в час пишет heartbeat в лог (один get_me на обе проверки)"""
+    checks = 0
     while True:
         try:
-            await asyncio.sleep(3600)  # Каждый час
-            # Проверяем, что бот все еще работает
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            checks += 1
             try:
                 me = await bot.get_me()
+            except Exception as e:
+                logger.warning(f"Проблема с соединением: {e}")
+                # Если соединение разорвано, это вызовет перезапуск в основном цикле
+                continue
+            if checks % HEARTBEAT_LOG_EVERY == 0:
                 uptime = datetime.datetime.now() - start_time
                 logger.info(f"Heartbeat: бот активен (@{me.username}), работает {uptime}")
-            except Exception as e:
-                logger.error(f"Heartbeat: ошибка при проверке состояния бота: {e}")
-                # Если не можем получить информацию о боте, значит соединение разорвано
-                # Это вызовет перезапуск polling в основном цикле
-                raise
+            else:
+                logger.debug("Проверка соединения: бот активен (@%s)", me.username)
         except asyncio.CancelledError:
             logger.info("Heartbeat задача отменена")
             break
@@ -151,73 +346,134 @@ async def heartbeat_task(start_time: datetime.datetime):
             logger.error(f"Ошибка в heartbeat_task: {e}", exc_info=True)
             await asyncio.sleep(60)  # Ждем перед следующей попыткой
 
-async def connection_check_task():
-    """Периодически проверяет соединение с Telegram API"""
+def update_game_activity(chat_id: int):
+    """Обновляет время последней активности игры и планирует её проверку на истечение"""
+    game = GAMES.get(chat_id)
+    if game is not None:
+        now = time.monotonic()
+        game.last_activity = now
+        # Старые записи этой игры не удаляем — они отсеются при очистке
+        entry = (now + GAME_TIMEOUT, chat_id)
+        heapq.heappush(EXPIRY_HEAP, entry)
+        # Будим задачу очистки, только если эта запись стала ближайшей
+        if EXPIRY_HEAP[0] == entry:
+            CLEANUP_WAKE.set()
+        GAMES_DIRTY.set()
+
+# --- Сохранение состояния ---
+# Поля, которые не имеют смысла после перезапуска
+TRANSIENT_GAME_FIELDS = ("pending_joins", "join_flush_task")
+
+def dump_games() -> bytes:
+    """Снимок GAMES в JSON; вызывается без await, поэтому снимок согласован"""
+    # time.monotonic() не переживает перезагрузку машины — на диск пишем время по часам
+    clock_offset = time.time() - time.monotonic()
+    data = {}
+    for chat_id, game in GAMES.items():
+        fields = {
+            name: getattr(game, name)
+            for name in Game.__slots__
+            if name not in TRANSIENT_GAME_FIELDS
+        }
+        fields["last_activity"] += clock_offset
+        data[chat_id] = fields
+    # множества (witnesses_drawn) orjson не умеет — сохраняем их списками
+    return orjson.dumps(data, default=list, option=orjson.OPT_NON_STR_KEYS)
+
+def write_games_file(payload: bytes):
+    # Пишем во временный файл и подменяем, чтобы при сбое не остался обрезанный JSON
+    tmp_path = GAMES_FILE.with_suffix(".json.tmp")
+    tmp_path.write_bytes(payload)
+    os.replace(tmp_path, GAMES_FILE)
+
+async def save_games():
+    try:
+        await asyncio.to_thread(write_games_file, dump_games())
+    except Exception as e:
+        logger.error(f"Не удалось сохранить состояние игр: {e}")
+
+def load_games():
+    """Восстанавливает GAMES из GAMES_FILE, пропуская уже истёкшие игры"""
+    if not GAMES_FILE.exists():
+        return
+    try:
+        data = orjson.loads(GAMES_FILE.read_bytes())
+        now = time.monotonic()
+        clock_offset = time.time() - now
+        for key, fields in data.items():
+            fields["last_activity"] -= clock_offset
+            # JSON хранит ключи строками — возвращаем user_id в int
+            fields["players"] = {int(uid): Player(**p) for uid, p in fields["players"].items()}
+            fields["witnesses_drawn"] = set(fields["witnesses_drawn"])
+            # после редеплоя файлы карт могли стать короче — индексы за их концом выбрасываем
+            fields["situation_deck"] = [i for i in fields["situation_deck"] if i < len(SITUATIONS)]
+            fields["witness_deck"] = [i for i in fields["witness_deck"] if i < len(WITNESSES)]
+            game = Game(**fields)
+            if now - game.last_activity >= GAME_TIMEOUT:
+                continue
+            chat_id = int(key)
+            GAMES[chat_id] = game
+            heapq.heappush(EXPIRY_HEAP, (game.last_activity + GAME_TIMEOUT, chat_id))
+    except Exception as e:
+        logger.warning(f"Не удалось восстановить состояние игр из {GAMES_FILE}: {e}")
+        GAMES.clear()
+        EXPIRY_HEAP.clear()
+        return
+    if GAMES:
+        logger.info(f"Восстановлено игр: {len(GAMES)}")
+
+async def persist_games_task():
+    """Фоновая запись GAMES на диск: изменения копятся GAMES_SAVE_DELAY секунд и пишутся разом"""
     while True:
         try:
-            await asyncio.sleep(1800)  # Каждые 30 минут
-            try:
-                # Простая проверка - получаем информацию о боте
-                me = await bot.get_me()
-                logger.debug(f"Проверка соединения: бот активен (@{me.username})")
-            except Exception as e:
-                logger.warning(f"Проблема с соединением: {e}")
-                # Если соединение разорвано, это вызовет перезапуск в основном цикле
+            await GAMES_DIRTY.wait()
+            await asyncio.sleep(GAMES_SAVE_DELAY)
+            GAMES_DIRTY.clear()
+            await save_games()
         except asyncio.CancelledError:
             break
-        except Exception as e:
-            logger.error(f"Ошибка в connection_check_task: {e}")
-            await asyncio.sleep(60)
-
-def update_game_activity(chat_id: int):
-    """Обновляет время последней активности игры"""
-    if chat_id in GAMES:
-        GAMES[chat_id]['last_activity'] = time.time()
 
 # --- Keyboards ---
-def start_game_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Присоединиться", callback_data="join")],
-        [InlineKeyboardButton(text="Закончить набор", callback_data="stop_join")],
-        [InlineKeyboardButton(text="Инструкция", callback_data="instructions")],
-        [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
-
-    ])
-    return kb
-
-def game_control_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Раздать роли", callback_data="assign_roles")],
-        [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
-    ])
-    return kb
-
-def situation_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Вытянуть карту свидетеля", callback_data="draw_witness")],
-        [InlineKeyboardButton(text="Начать дебаты (прокурор/адвокат)", callback_data="start_debate")],
-        [InlineKeyboardButton(text="Призвать судью к вердикту", callback_data="judge_verdict")],
-        [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
-
-    ])
-    return kb
-
-def debate_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Вытянуть карту свидетеля", callback_data="draw_witness")],
-        [InlineKeyboardButton(text="Призвать судью к вердикту", callback_data="judge_verdict")],
-        [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
-
-    ])
-    return kb
-
-def roles_kb():
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Начать раунд (ситуация)", callback_data="start_round")],
-        [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
-
-    ])
-    return kb
+# Клавиатуры статичны, поэтому собираем их один раз при загрузке модуля
+START_GAME_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Присоединиться", callback_data="join")],
+    [InlineKeyboardButton(text="Закончить набор", callback_data="stop_join")],
+    [InlineKeyboardButton(text="Инструкция", callback_data="instructions")],
+    [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
+])
+
+GAME_CONTROL_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Раздать роли", callback_data="assign_roles")],
+    [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
+])
+
+SITUATION_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Вытянуть карту свидетеля", callback_data="draw_witness")],
+    [InlineKeyboardButton(text="Начать дебаты (прокурор/адвокат)", callback_data="start_debate")],
+    [InlineKeyboardButton(text="Призвать судью к вердикту", callback_data="judge_verdict")],
+    [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
+])
+
+DEBATE_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Вытянуть карту свидетеля", callback_data="draw_witness")],
+    [InlineKeyboardButton(text="Призвать судью к вердикту", callback_data="judge_verdict")],
+    [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
+])
+
+ROLES_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Начать раунд (ситуация)", callback_data="start_round")],
+    [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
+])
+
+VERDICT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Оправдать", callback_data="verdict_acquit")],
+    [InlineKeyboardButton(text="Осудить", callback_data="verdict_convict")]
+])
+
+POST_VERDICT_KB = InlineKeyboardMarkup(inline_keyboard=[
+    [InlineKeyboardButton(text="Новый раунд", callback_data="start_round")],
+    [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
+])
 
 # --- Команды ---
 @dp.message(Command("start", "help"))
@@ -244,7 +500,7 @@ async def on_chat_member_update(update: ChatMemberUpdated):
             # Если бот был добавлен в группу (не был участником, а теперь стал)
             if old_status in (None, "left", "kicked") and new_status in ("member", "administrator"):
                 try:
-                    await bot.send_message(
+                    await send(
                         update.chat.id,
                         "Всем привет! Чтобы начать новую игру запустите команду /newgame"
                     )
@@ -261,327 +517,340 @@ async def cmd_newgame(message: Message):
         return
 
     chat_id = message.chat.id
-    async with GAMES_LOCK:
-        GAMES[chat_id] = {
-            "players": {},
-            "order": [],
-            "roles_assigned": False,
-            "current_situation": None,
-            "used_situations": set(),
-            "used_witnesses": set(),
-            "stage": "joining",
-            "judge_id": None,
-            "defendant_id": None,
-            "witness_map": {},
-            "last_activity": time.time(),
-        }
+    async with game_lock(chat_id):
+        GAMES[chat_id] = Game(
+            situation_deck=new_deck(len(SITUATIONS)),
+            witness_deck=new_deck(len(WITNESSES)),
+        )
+        update_game_activity(chat_id)
 
     await message.reply(
         "Новая игра создана! Нажмите «Присоединиться», чтобы вступить в игру.\n"
         f"Минимум игроков: {config.MIN_PLAYERS}. Когда все присоединятся — ведущий (или админ чата) нажмёт «Закончить набор».",
-        reply_markup=start_game_kb()
+        reply_markup=START_GAME_KB
         )
 
 # --- Callbacks: join / stop_join / assign roles / start round / draw witness / etc. ---
-@dp.callback_query(lambda c: c.data == "join")
 async def cb_join(callback_query: CallbackQuery):
-    try:
-        chat_id = callback_query.message.chat.id
-        user = callback_query.from_user
-
-        async with GAMES_LOCK:
-            game = GAMES.get(chat_id)
-            if not game:
-                await bot.answer_callback_query(callback_query.id, "Игра не найдена. Запустите /newgame.")
-                return
-
-            if user.id in game["players"]:
-                await bot.answer_callback_query(callback_query.id, "Вы уже в игре.")
-                return
-
-            game["players"][user.id] = {"name": user.full_name, "role": None}
-            game["order"].append(user.id)
-            game["last_activity"] = time.time()
+    chat_id = callback_query.message.chat.id
+    user = callback_query.from_user
 
-        await bot.answer_callback_query(callback_query.id, "Вы присоединились к игре.")
-        await bot.send_message(chat_id, f"{get_mention(user)} присоединился к игре.", parse_mode=ParseMode.HTML)
-    except Exception as e:
-        logger.error(f"Ошибка в cb_join: {e}", exc_info=True)
-        try:
-            await bot.answer_callback_query(callback_query.id, "Произошла ошибка. Попробуйте позже.")
-        except:
-            pass
+    async with game_lock(chat_id):
+        game = GAMES.get(chat_id)
+        if not game:
+            alert = "Игра не найдена. Запустите /newgame."
+        elif user.id in game.players:
+            alert = "Вы уже в игре."
+        else:
+            alert = "Вы присоединились к игре."
+            # упоминание собираем один раз при входе и дальше переиспользуем
+            mention = get_mention(user)
+            game.players[user.id] = Player(user.full_name, mention)
+            game.order.append(user.id)
+            game.status_text = None
+            update_game_activity(chat_id)
+            # входы за JOIN_FLUSH_DELAY объявляем одним сообщением
+            game.pending_joins.append(mention)
+            if game.join_flush_task is None:
+                game.join_flush_task = asyncio.create_task(flush_joins(chat_id))
+
+    await bot.answer_callback_query(callback_query.id, alert)
 
-@dp.callback_query(lambda c: c.data == "stop_join")
 async def cb_stop_join(callback_query: CallbackQuery):
-    try:
-        chat_id = callback_query.message.chat.id
-        caller = callback_query.from_user
+    chat_id = callback_query.message.chat.id
 
-        async with GAMES_LOCK:
-            game = GAMES.get(chat_id)
-            if not game:
-                await bot.answer_callback_query(callback_query.id, "Игра не найдена.")
-                return
+    async with game_lock(chat_id):
+        game = GAMES.get(chat_id)
+        if not game:
+            alert = "Игра не найдена."
+        elif len(game.players) < config.MIN_PLAYERS:
+            alert = f"Слишком мало игроков ({len(game.players)}). Нужны минимум {config.MIN_PLAYERS}."
+        else:
+            alert = None
+            update_game_activity(chat_id)
+            names = [p.name for p in game.players.values()]
 
-            player_count = len(game["players"])
-            if player_count < config.MIN_PLAYERS:
-                await bot.answer_callback_query(callback_query.id, f"Слишком мало игроков ({player_count}). Нужны минимум {config.MIN_PLAYERS}.")
-                return
+    if alert:
+        await bot.answer_callback_query(callback_query.id, alert)
+        return
 
-            game["last_activity"] = time.time()
-            names = [p["name"] for p in game["players"].values()]
-        
-        txt = "Набор окончен. Игроки:\n" + "\n".join(f"- {n}" for n in names)
-        await bot.answer_callback_query(callback_query.id, "Набор окончен. Можете раздать роли.")
-        await bot.send_message(chat_id, txt, reply_markup=game_control_kb())
-    except Exception as e:
-        logger.error(f"Ошибка в cb_stop_join: {e}", exc_info=True)
-        try:
-            await bot.answer_callback_query(callback_query.id, "Произошла ошибка. Попробуйте позже.")
-        except:
-            pass
+    txt = "Набор окончен. Игроки:\n" + "\n".join(f"- {n}" for n in names)
+    await bot.answer_callback_query(callback_query.id, "Набор окончен. Можете раздать роли.")
+    send_later(chat_id, txt, reply_markup=GAME_CONTROL_KB)
 
-@dp.callback_query(lambda c: c.data == "assign_roles")
 async def cb_assign_roles(callback_query: CallbackQuery):
     chat_id = callback_query.message.chat.id
 
-    async with GAMES_LOCK:
+    async with game_lock(chat_id):
         game = GAMES.get(chat_id)
-        if not game:
-            await bot.answer_callback_query(callback_query.id, "Игра не найдена.")
-            return
+        if game:
+            players = list(game.players.keys())
+            random.shuffle(players)
+            n = len(players)
+
+            # Базовые роли: судья, прокурор, адвокат, подсудимый, остальные — свидетели/присяжные
+            for i, uid in enumerate(players):
+                game.players[uid].role = BASE_ROLES[i] if i < len(BASE_ROLES) else "Свидетель"
+
+            # роли раздаются по позиции, поэтому судья и подсудимый известны сразу
+            game.judge_id = players[0] if n > 0 else None
+            game.defendant_id = players[3] if n > 3 else None
+            game.roles_assigned = True
+            # роли до конца игры не меняются — объявление собираем один раз
+            game.roles_announcement = "Роли распределены:\n" + "\n".join(
+                f"{p.mention} — {p.role}" for p in game.players.values()
+            )
+            game.status_text = None
+            update_game_activity(chat_id)
+            # снимок под lock'ом: после его освобождения состав игроков может измениться
+            announcement = game.roles_announcement
+            recipients = [(uid, p.role, p.name) for uid, p in game.players.items()]
+
+    if not game:
+        await bot.answer_callback_query(callback_query.id, "Игра не найдена.")
+        return
+
+    # Отвечаем на нажатие сразу, до рассылки ЛС, чтобы кнопка не "висела"
+    await bot.answer_callback_query(callback_query.id, "Роли разданы, проверьте личные сообщения.")
+
+    # Объявление в чате — сразу, не дожидаясь рассылки ЛС
+    await send(chat_id, announcement, parse_mode=ParseMode.HTML, reply_markup=ROLES_KB)
 
-        players = list(game["players"].keys())
-        random.shuffle(players)
-        n = len(players)
-
-        # Базовые роли: судья, прокурор, адвокат, подсудимый, остальные — свидетели/присяжные
-        roles = ["Судья", "Прокурор", "Адвокат", "Подсудимый"] #["Судья", "Прокурор", "Адвокат", "Подсудимый"]
-        # если мало игроков — подгоняем
-        if n < len(roles):
-            roles = roles[:n]
-
-        assigned = {}
-        for i, uid in enumerate(players):
-            role = roles[i] if i < len(roles) else "Свидетель"
-            assigned[uid] = role
-            game["players"][uid]["role"] = role
-
-        # определим id судьи и подсудимого для быстрых ссылок
-        judge_id = next((uid for uid, r in assigned.items() if r == "Судья"), None)
-        defendant_id = next((uid for uid, r in assigned.items() if r == "Подсудимый"), None)
-        game["judge_id"] = judge_id
-        game["defendant_id"] = defendant_id
-        game["roles_assigned"] = True
-        game["last_activity"] = time.time()
-
-    # Отправить приватные сообщения с ролью каждому игроку
+    # Отправить приватные сообщения с ролью каждому игроку (параллельно)
+    results = await asyncio.gather(
+        *(send(uid, f"Вам назначена роль: {role}")
+          for uid, role, _ in recipients),
+        return_exceptions=True,
+    )
     failed_users = []
-    for uid, pdata in game["players"].items():
-        try:
-            await bot.send_message(uid, f"Вам назначена роль: {pdata['role']}", parse_mode=ParseMode.MARKDOWN)
-        except Exception as e:
-            logger.warning(f"Не удалось отправить приватное сообщение {uid}: {e}")
-            failed_users.append(pdata['name'])
-    
+    for (uid, _, name), result in zip(recipients, results):
+        if isinstance(result, Exception):
+            logger.warning(f"Не удалось отправить приватное сообщение {uid}: {result}")
+            failed_users.append(name)
+
     # Если не удалось отправить некоторым пользователям, сообщим об этом
     if failed_users:
-        await bot.send_message(chat_id, f"Не удалось отправить роли в ЛС следующим пользователям: {', '.join(failed_users)}. Они могут узнать свою роль через команду /status.")
-
-    # Объявление в чате
-    lines = []
-    for uid, pdata in game["players"].items():
-        role = pdata["role"]
-        mention = f"<a href='tg://user?id={uid}'>{pdata['name']}</a>"
-        lines.append(f"{mention} — {role}")
-    msg = "Роли распределены:\n" + "\n".join(lines)
-    await bot.answer_callback_query(callback_query.id, "Роли разданы (личные сообщения отправлены).")
-    await bot.send_message(chat_id, msg, parse_mode=ParseMode.HTML, reply_markup=roles_kb())
-
-@dp.callback_query(lambda c: c.data == "start_round")
+        await send(chat_id, f"Не удалось отправить роли в ЛС следующим пользователям: {', '.join(failed_users)}. Они могут узнать свою роль через команду /status.")
+
 async def cb_start_round(callback_query: CallbackQuery):
     chat_id = callback_query.message.chat.id
-    async with GAMES_LOCK:
+    async with game_lock(chat_id):
         game = GAMES.get(chat_id)
-        if not game or not game.get("roles_assigned"):
-            await bot.answer_callback_query(callback_query.id, "Роли не распределены или игра не найдена.")
-            return
-
-        # выбрать ситуацию случайно и отметить использованную
-        situation = pick_random_and_mark(SITUATIONS, game["used_situations"])
-        if not situation:
-            await bot.answer_callback_query(callback_query.id, "Нет доступных ситуаций.")
-            return
-
-        game["current_situation"] = situation
-        game["stage"] = "situation"
-        game["last_activity"] = time.time()
-        # очистим карты свидетелей на новый раунд
-        game["witness_map"] = {}
+        if not game or not game.roles_assigned:
+            alert = "Роли не распределены или игра не найдена."
+        else:
+            # выбрать ситуацию случайно и отметить использованную
+            situation = draw_random(SITUATIONS_RENDERED, game.situation_deck)
+            if not situation:
+                alert = "Нет доступных ситуаций."
+            else:
+                alert = None
+                game.current_situation = situation
+                game.stage = "situation"
+                update_game_activity(chat_id)
+                # очистим карты свидетелей на новый раунд
+                game.witnesses_drawn = set()
+
+    if alert:
+        await bot.answer_callback_query(callback_query.id, alert)
+        return
 
-    title = situation.get("title", "Ситуация")
-    text = situation.get("text", "")
-    article = situation.get("article", "")
-    consequence = situation.get("consequence", "")
     await bot.answer_callback_query(callback_query.id, "Новая ситуация выдана.")
-    await bot.send_message(chat_id, f"<b>СИТУАЦИЯ:</b> {title}\n\n{text}\n\n{article}\n\n{consequence}", parse_mode=ParseMode.HTML, reply_markup=situation_kb())
-@dp.callback_query(lambda c: c.data == "instructions")
+    send_later(chat_id, situation, parse_mode=ParseMode.HTML, reply_markup=SITUATION_KB)
+
 async def cb_instructions(callback_query: CallbackQuery):
+    global INSTRUCTIONS_FILE_ID
     chat_id = callback_query.message.chat.id
     
+    if not INSTRUCTIONS_FILE_ID and INSTRUCTIONS_FILE is None:
+        await bot.answer_callback_query(callback_query.id, "Файл инструкции не найден.")
+        return
+
+    # Отвечаем сразу, загрузка картинки может занять время
+    await bot.answer_callback_query(callback_query.id, "Отправляю инструкцию...")
     try:
-        # Проверяем существование файла
-        from pathlib import Path
-        instructions_path = Path("./instructions.jpg")
-        
-        if not instructions_path.exists():
-            await bot.answer_callback_query(callback_query.id, "Файл инструкции не найден.")
-            return
-            
-        # Отправка файла
-        from aiogram.types import FSInputFile
-        pdf_file = FSInputFile(instructions_path)
-        await bot.send_photo(chat_id=chat_id, photo=pdf_file, caption="Инструкция по игре")
-        await bot.answer_callback_query(callback_query.id, "Инструкция отправлена.")
+        if INSTRUCTIONS_FILE_ID:
+            await bot.send_photo(chat_id=chat_id, photo=INSTRUCTIONS_FILE_ID, caption="Инструкция по игре")
+        else:
+            msg = await bot.send_photo(chat_id=chat_id, photo=INSTRUCTIONS_FILE, caption="Инструкция по игре")
+            INSTRUCTIONS_FILE_ID = msg.photo[-1].file_id
     except Exception as e:
         logger.error(f"Ошибка при отправке инструкции: {e}")
-        await bot.answer_callback_query(callback_query.id, "Ошибка при отправке файла.")
+        await send(chat_id, "Не удалось отправить инструкцию. Попробуйте позже.")
 
-@dp.callback_query(lambda c: c.data == "draw_witness")
 async def cb_draw_witness(callback_query: CallbackQuery):
     chat_id = callback_query.message.chat.id
     user = callback_query.from_user
 
-    async with GAMES_LOCK:
+    async with game_lock(chat_id):
         game = GAMES.get(chat_id)
-        if not game or not game.get("current_situation"):
-            await bot.answer_callback_query(callback_query.id, "Нет активной ситуации. Запустите раунд.")
-            return
-
-        # у свидетеля может быть максимум одна карта; если уже есть — покажем
-        if user.id in game["witness_map"]:
-            await bot.answer_callback_query(callback_query.id, "Вы уже вытянули свою карту свидетеля.")
-            return
-
-        witness = pick_random_and_mark(WITNESSES, game["used_witnesses"])
-        if not witness:
-            await bot.answer_callback_query(callback_query.id, "Нет доступных карт свидетелей.")
-            return
+        if not game or not game.current_situation:
+            alert = "Нет активной ситуации. Запустите раунд."
+        # у свидетеля может быть максимум одна карта
+        elif user.id in game.witnesses_drawn:
+            alert = "Вы уже вытянули свою карту свидетеля."
+        else:
+            witness = draw_random(WITNESSES_RENDERED, game.witness_deck)
+            if not witness:
+                alert = "Нет доступных карт свидетелей."
+            else:
+                alert = None
+                game.witnesses_drawn.add(user.id)
+                update_game_activity(chat_id)
+                # свидетелем может быть и не игрок — тогда упоминание соберём при необходимости
+                player = game.players.get(user.id)
+                mention = player.mention if player else None
+
+    if alert:
+        await bot.answer_callback_query(callback_query.id, alert)
+        return
 
-        game["witness_map"][user.id] = witness
-        game["last_activity"] = time.time()
+    # отвечаем на нажатие до отправки ЛС, чтобы кнопка не "висела"; текст нейтральный —
+    # ЛС может оказаться недоступен
+    await bot.answer_callback_query(callback_query.id, "Отправляю карту свидетеля...")
 
     # отправить приватно текст свидетелю
     try:
-        witness_title = witness.get("title", "Карта свидетеля")
-        witness_text = witness.get("text", "")
-        await bot.send_message(user.id, f"Ваша кураторская карта свидетеля:\n\n<b>{witness_title}</b>\n\n{witness_text}", parse_mode=ParseMode.HTML)
-        await bot.answer_callback_query(callback_query.id, "Карта отправлена вам в личные сообщения.")
+        await send(user.id, witness, parse_mode=ParseMode.HTML)
     except Exception as e:
         logger.warning(f"Не удалось отправить свидетелю приватную карту {user.id}: {e}")
         # если нельзя писать приватно, отправим в чат с упоминанием (без раскрытия всей карты)
-        await bot.send_message(chat_id, f"{get_mention(user)} вытянул(а) карту свидетеля (карта отправлена в ЛС или недоступна).", parse_mode=ParseMode.HTML)
-        await bot.answer_callback_query(callback_query.id, "Карта отправлена в чат (ЛС недоступны).")
+        await send(chat_id, f"{mention or get_mention(user)} вытянул(а) карту свидетеля, но личные сообщения недоступны — напишите боту в ЛС.", parse_mode=ParseMode.HTML)
 
-@dp.callback_query(lambda c: c.data == "start_debate")
 async def cb_start_debate(callback_query: CallbackQuery):
     chat_id = callback_query.message.chat.id
-    async with GAMES_LOCK:
+    async with game_lock(chat_id):
         game = GAMES.get(chat_id)
-        if not game or not game.get("current_situation"):
-            await bot.answer_callback_query(callback_query.id, "Нет активного раунда.")
-            return
-        game["stage"] = "debate"
-        game["last_activity"] = time.time()
+        active = bool(game and game.current_situation)
+        if active:
+            game.stage = "debate"
+            update_game_activity(chat_id)
+    if not active:
+        await bot.answer_callback_query(callback_query.id, "Нет активного раунда.")
+        return
     await bot.answer_callback_query(callback_query.id, "Стадия дебатов началась.")
-    await bot.send_message(chat_id, "Начинаются дебаты: прокурор и адвокат представляют свои аргументы. Судья может объявить перерыв или перейти к вердикту.", reply_markup=debate_kb())
+    send_later(chat_id, "Начинаются дебаты: прокурор и адвокат представляют свои аргументы. Судья может объявить перерыв или перейти к вердикту.", reply_markup=DEBATE_KB)
 
-@dp.callback_query(lambda c: c.data == "judge_verdict")
 async def cb_judge_verdict(callback_query: CallbackQuery):
     chat_id = callback_query.message.chat.id
     caller = callback_query.from_user
-    async with GAMES_LOCK:
+    async with game_lock(chat_id):
         game = GAMES.get(chat_id)
         if not game:
-            await bot.answer_callback_query(callback_query.id, "Игра не найдена.")
-            return
-        judge_id = game.get("judge_id")
-        if judge_id is None:
-            await bot.answer_callback_query(callback_query.id, "Судья не назначен.")
-            return
+            alert = "Игра не найдена."
+        elif game.judge_id is None:
+            alert = "Судья не назначен."
         # только судья может выносить формальный вердикт (по правилам)
-        if caller.id != judge_id:
-            await bot.answer_callback_query(callback_query.id, "Только судья может вызвать вердикт.")
-            return
+        elif caller.id != game.judge_id:
+            alert = "Только судья может вызвать вердикт."
+        else:
+            alert = None
+            game.stage = "verdict"
+            update_game_activity(chat_id)
+            judge_mention = game.players[game.judge_id].mention
 
-        game["stage"] = "verdict"
-        game["last_activity"] = time.time()
-        # случайный вывод из conclusions (если есть)
-        conclusion = pick_random_and_mark(CONCLUSIONS, set()) if CONCLUSIONS else None
+    if alert:
+        await bot.answer_callback_query(callback_query.id, alert)
+        return
 
     # показываем судье варианты: Оправдать / Осудить
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Оправдать", callback_data="verdict_acquit")],
-        [InlineKeyboardButton(text="Осудить", callback_data="verdict_convict")]
-    ])
     await bot.answer_callback_query(callback_query.id, "Судья готов выносить вердикт.")
-    await bot.send_message(chat_id, f"Судья {get_mention(caller)} готов вынести решение. Если хотите — судья может выбрать один из вариантов ниже.", parse_mode=ParseMode.HTML, reply_markup=kb)
+    send_later(chat_id, f"Судья {judge_mention} готов вынести решение. Если хотите — судья может выбрать один из вариантов ниже.", parse_mode=ParseMode.HTML, reply_markup=VERDICT_KB)
 
-@dp.callback_query(lambda c: c.data.startswith("verdict_"))
 async def cb_verdict(callback_query: CallbackQuery):
     verdict_choice = callback_query.data.split("_", 1)[1]  # convict / acquit
     chat_id = callback_query.message.chat.id
     caller = callback_query.from_user
 
-    async with GAMES_LOCK:
+    async with game_lock(chat_id):
         game = GAMES.get(chat_id)
         if not game:
-            await bot.answer_callback_query(callback_query.id, "Игра не найдена.")
-            return
-        judge_id = game.get("judge_id")
-        if caller.id != judge_id:
-            await bot.answer_callback_query(callback_query.id, "Только судья может подтверждать вердикт.")
-            return
-
-        # формируем текст вердикта
-        if verdict_choice == "acquit":
-            result_text = "Судья решил: Оправдать подсудимого."
+            alert = "Игра не найдена."
+        elif caller.id != game.judge_id:
+            alert = "Только судья может подтверждать вердикт."
         else:
-            result_text = "Судья решил: Осудить подсудимого."
+            alert = None
+            game.stage = "finished"
+            GAMES_DIRTY.set()
 
-        game["stage"] = "finished"
+    if alert:
+        await bot.answer_callback_query(callback_query.id, alert)
+        return
+
+    # формируем текст вердикта
+    if verdict_choice == "acquit":
+        result_text = "Судья решил: Оправдать подсудимого."
+    else:
+        result_text = "Судья решил: Осудить подсудимого."
 
     await bot.answer_callback_query(callback_query.id, "Вердикт записан.")
-    await bot.send_message(chat_id, result_text, parse_mode=ParseMode.MARKDOWN)
+    await send(chat_id, result_text)
     # после вердикта предложим начать новый раунд или завершить игру
-    kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(text="Новый раунд", callback_data="start_round")],
-        [InlineKeyboardButton(text="Завершить игру", callback_data="end_game")]
-    ])
-    await bot.send_message(chat_id, "Дальше: выбрать один из вариантов.", reply_markup=kb)
+    await send(chat_id, "Дальше: выбрать один из вариантов.", reply_markup=POST_VERDICT_KB)
 
-@dp.callback_query(lambda c: c.data == "end_game")
 async def cb_end_game(callback_query: CallbackQuery):
     chat_id = callback_query.message.chat.id
-    async with GAMES_LOCK:
-        if chat_id in GAMES:
-            del GAMES[chat_id]
+    async with game_lock(chat_id):
+        if GAMES.pop(chat_id, None) is not None:
+            GAMES_DIRTY.set()
+    drop_game_lock(chat_id)
     await bot.answer_callback_query(callback_query.id, "Игра завершена и состояние удалено.")
-    await bot.send_message(chat_id, "Игра завершена. Спасибо за участие! Для новой игры используйте /newgame")
+    send_later(chat_id, "Игра завершена. Спасибо за участие! Для новой игры используйте /newgame")
+
+# Маршрутизация нажатий кнопок: один обработчик и поиск по callback_data в словаре
+# вместо последовательной проверки фильтров каждого обработчика
+CALLBACK_HANDLERS = {
+    "join": cb_join,
+    "stop_join": cb_stop_join,
+    "assign_roles": cb_assign_roles,
+    "start_round": cb_start_round,
+    "instructions": cb_instructions,
+    "draw_witness": cb_draw_witness,
+    "start_debate": cb_start_debate,
+    "judge_verdict": cb_judge_verdict,
+    "verdict_acquit": cb_verdict,
+    "verdict_convict": cb_verdict,
+    "end_game": cb_end_game,
+}
+
+@dp.callback_query()
+async def on_callback(callback_query: CallbackQuery):
+    handler = CALLBACK_HANDLERS.get(callback_query.data)
+    if handler is None:
+        # кнопка от старой версии бота — просто убираем "часики"
+        await bot.answer_callback_query(callback_query.id)
+        return
+    # общая обработка ошибок для всех кнопок: пишем в лог и снимаем "часики" у пользователя
+    try:
+        await handler(callback_query)
+    except Exception as e:
+        logger.error(f"Ошибка в {handler.__name__}: {e}", exc_info=True)
+        try:
+            await bot.answer_callback_query(callback_query.id, "Произошла ошибка. Попробуйте позже.")
+        except TelegramAPIError:
+            pass
+    finally:
+        # кнопка из чата без игры не должна оставлять за собой lock
+        if callback_query.message and callback_query.message.chat.id not in GAMES:
+            drop_game_lock(callback_query.message.chat.id)
 
 # --- Команда для показа статуса (опционально) ---
 @dp.message(Command("status"))
 async def cmd_status(message: Message):
     chat_id = message.chat.id
-    async with GAMES_LOCK:
+    async with game_lock(chat_id):
         game = GAMES.get(chat_id)
-        if not game:
-            await message.reply("Игра в этом чате не запущена.")
-            return
-        players = game["players"]
-        lines = [f"{pdata['name']} — {pdata.get('role','(не назначена)')}" for uid,pdata in players.items()]
-        await message.reply("Текущие игроки:\n" + "\n".join(lines))
+        if game and game.status_text is None:
+            game.status_text = "Текущие игроки:\n" + "\n".join(
+                f"{p.name} — {p.role or '(не назначена)'}" for p in game.players.values()
+            )
+        status_text = game.status_text if game else None
+
+    if status_text is None:
+        drop_game_lock(chat_id)
+        await message.reply("Игра в этом чате не запущена.")
+        return
+    await message.reply(status_text)
 
 # --- Команда для очистки неактивных игр (только для админов) ---
 @dp.message(Command("cleanup"))
@@ -590,11 +859,11 @@ async def cmd_cleanup(message: Message):
     if message.chat.type != ChatType.PRIVATE:
         # В групповом чате проверяем права админа
         try:
-            chat_member = await bot.get_chat_member(message.chat.id, message.from_user.id)
-            if chat_member.status not in ['creator', 'administrator']:
+            if not await is_admin(message.chat.id, message.from_user.id):
                 await message.reply("Только администраторы могут использовать эту команду.")
                 return
-        except:
+        except TelegramAPIError as e:
+            logger.warning(f"Не удалось проверить права администратора в чате {message.chat.id}: {e}")
             await message.reply("Не удалось проверить права администратора.")
             return
     
@@ -603,11 +872,12 @@ async def cmd_cleanup(message: Message):
 
 # --- Обработка ошибок (логирование) ---
 @dp.error()
-async def handle_errors(update: types.Update, exception: Exception):
+async def handle_errors(event: ErrorEvent):
     """Глобальный обработчик ошибок"""
+    update, exception = event.update, event.exception
     try:
         # Логируем ошибку
-        logger.error(f"Ошибка при обработке обновления {update}: {exception}", exc_info=True)
+        logger.error(f"Ошибка при обработке обновления {update.update_id}: {exception}", exc_info=exception)
         
         # Обрабатываем специфичные ошибки Telegram
         if isinstance(exception, Exception):
@@ -639,115 +909,167 @@ async def handle_errors(update: types.Update, exception: Exception):
         logger.critical(f"Критическая ошибка в обработчике ошибок: {e}")
         return True
 
+STABLE_POLLING_TIME = 300  # секунд работы polling, после которых он считается успешным
+# Пауза перед перезапуском polling растёт экспоненциально: 1, 2, 4, ... до 10 минут
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 600
+# Случайная добавка до +50%, чтобы экземпляры после сбоя Telegram не переподключались разом
+RETRY_JITTER = 0.5
+# Жёсткий предел запусков polling за минуту — поверх экспоненциальной задержки
+MAX_POLLING_STARTS_PER_MINUTE = 5
+SHUTDOWN_TIMEOUT = 5  # секунд на закрытие сессии при остановке
+
+async def run_polling():
+    """Получает обновления через long polling с перезапуском при ошибках"""
+    # Бесконечный цикл перезапуска при ошибках
+    consecutive_errors = 0
+    max_consecutive_errors = 5
+    is_first_start = True  # Флаг для первого запуска
+    # Запрашиваем у Telegram только те типы обновлений, для которых есть обработчики
+    allowed_updates = dp.resolve_used_update_types()
+    # Время последних запусков polling: если их уже максимум за минуту — ждём
+    recent_starts = deque(maxlen=MAX_POLLING_STARTS_PER_MINUTE)
+
+    while True:
+        if len(recent_starts) == recent_starts.maxlen:
+            wait = 60 - (time.monotonic() - recent_starts[0])
+            if wait > 0:
+                logger.warning(f"Слишком частые перезапуски polling, пауза {wait:.1f} секунд")
+                await asyncio.sleep(wait)
+        started_at = time.monotonic()
+        recent_starts.append(started_at)
+        try:
+            logger.info("Запуск бота...")
+            if is_first_start:
+                # При первом запуске очищаем старые обновления, при перезапуске - не сбрасываем.
+                # Заодно снимаем webhook, оставшийся от режима WEBHOOK_URL: пока он задан,
+                # getUpdates отвечает 409 Conflict, а aiogram повторяет запрос молча и бесконечно
+                await bot.delete_webhook(drop_pending_updates=True)
+                is_first_start = False
+            # close_bot_session=False - не закрываем сессию при перезапуске
+            await dp.start_polling(
+                bot,
+                allowed_updates=allowed_updates,
+                close_bot_session=False,  # Важно для перезапуска
+                polling_timeout=30,  # Таймаут для каждого запроса getUpdates
+            )
+            # Если polling завершился без ошибки (например, KeyboardInterrupt)
+            break
+        except KeyboardInterrupt:
+            logger.info("Бот остановлен пользователем")
+            break
+        except TelegramUnauthorizedError as e:
+            # Токен неверный или отозван — перезапуск ничего не изменит
+            logger.critical(f"Telegram отклонил токен бота: {e}")
+            break
+        except Exception as e:
+            error_msg = str(e)
+            # Если polling успел стабильно поработать, прошлые ошибки уже не в счёт:
+            # начинаем с минимальной задержки, а не с увеличенной
+            if time.monotonic() - started_at >= STABLE_POLLING_TIME:
+                consecutive_errors = 0
+            consecutive_errors += 1
+
+            # Логируем ошибку
+            logger.error(f"Ошибка при работе бота (ошибка #{consecutive_errors}): {e}", exc_info=True)
+
+            # Специальная обработка различных типов ошибок
+            if "Conflict" in error_msg or "getUpdates" in error_msg:
+                logger.warning("Обнаружен конфликт с другим экземпляром бота")
+                logger.warning("Убедитесь, что запущен только один экземпляр бота на Render!")
+            elif "timeout" in error_msg.lower() or "timed out" in error_msg.lower():
+                logger.warning("Таймаут соединения - это нормально при долгом простое")
+            elif "Connection" in error_msg or "network" in error_msg.lower():
+                logger.warning("Проблема с сетью - переподключение...")
+            if consecutive_errors >= max_consecutive_errors:
+                logger.critical(f"Слишком много последовательных ошибок ({consecutive_errors})")
+
+            # Экспоненциальная задержка со случайной добавкой
+            retry_delay = min(
+                RETRY_BASE_DELAY * 2 ** (consecutive_errors - 1) * (1 + random.random() * RETRY_JITTER),
+                RETRY_MAX_DELAY,
+            )
+            logger.info(f"Перезапуск через {retry_delay:.1f} секунд...")
+            await asyncio.sleep(retry_delay)
+
+# Сигнал остановки для режима webhook (выставляется по SIGTERM/SIGINT)
+STOP_EVENT = asyncio.Event()
+
+async def run_webhook():
+    """Получает обновления через webhook (aiohttp-сервер в том же event loop)"""
+    app = web.Application()
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=config.WEBHOOK_SECRET,
+    ).register(app, path=config.WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+    # В этом режиме health check отдаёт тот же сервер
+    app.router.add_get("/health", make_health_handler())
+
+    await bot.set_webhook(
+        config.WEBHOOK_URL + config.WEBHOOK_PATH,
+        drop_pending_updates=True,
+        allowed_updates=dp.resolve_used_update_types(),
+        secret_token=config.WEBHOOK_SECRET,
+    )
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", config.PORT).start()
+    logger.info(f"Webhook сервер запущен на порту {config.PORT}")
+    # aiogram ловит сигналы только в start_polling, поэтому здесь ставим обработчики сами,
+    # иначе по SIGTERM от платформы не выполнится finally в main() (сохранение игр и т.д.)
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, STOP_EVENT.set)
+    try:
+        # Обработка идёт в aiohttp, здесь просто ждём сигнала остановки
+        await STOP_EVENT.wait()
+        logger.info("Получен сигнал остановки")
+    finally:
+        await runner.cleanup()
+
 async def main():
     start_time = datetime.datetime.now()
     logger.info(f"Бот запущен в {start_time.strftime('%Y-%m-%d %H:%M:%S')}")
     
-    # Запускаем health check сервер в фоне (для Render и Railway)
-    health_server_thread = None
-    if os.environ.get('RENDER') or os.environ.get('PORT'):
+    # Запускаем health check сервер в том же event loop (для Render и Railway)
+    health_runner = None
+    # В режиме webhook health check обслуживает сам webhook сервер
+    if config.PLATFORM and not config.WEBHOOK_URL:
         try:
-            import threading
-            from health_check import start_health_server
-            health_server_thread = threading.Thread(target=start_health_server, daemon=True)
-            health_server_thread.start()
-            platform = "Render" if os.environ.get('RENDER') else "Railway"
-            logger.info(f"Health check server started for {platform}")
+            health_runner = await start_health_server(config.PORT, is_alive=bot_is_alive)
+            logger.info(f"Health check server started for {config.PLATFORM}")
         except Exception as e:
             logger.warning(f"Failed to start health check server: {e}")
     
-    # Запускаем задачу очистки в фоне
-    cleanup_task_handle = asyncio.create_task(cleanup_task())
-    
-    # Запускаем heartbeat задачу
-    heartbeat_task_handle = asyncio.create_task(heartbeat_task(start_time))
-    
-    # Запускаем задачу проверки соединения
-    connection_check_handle = asyncio.create_task(connection_check_task())
-    
-    # Бесконечный цикл перезапуска при ошибках
-    retry_delay = 30  # секунд
-    consecutive_errors = 0
-    max_consecutive_errors = 5
-    is_first_start = True  # Флаг для первого запуска
-
+    load_games()
     try:
-        while True:
+        # TaskGroup дожидается отмены фоновых задач при любом выходе из блока
+        async with asyncio.TaskGroup() as tg:
+            background_tasks = [
+                tg.create_task(cleanup_task()),  # очистка неактивных игр
+                tg.create_task(persist_games_task()),
+                tg.create_task(heartbeat_task(start_time)),  # проверка соединения и heartbeat
+            ]
             try:
-                logger.info("Запуск бота...")
-                # При первом запуске очищаем старые обновления, при перезапуске - не сбрасываем
-                # close_bot_session=False - не закрываем сессию при перезапуске
-                await dp.start_polling(
-                    bot,
-                    drop_pending_updates=is_first_start,  # Очищаем только при первом запуске
-                    allowed_updates=["message", "callback_query", "chat_member"],
-                    close_bot_session=False,  # Важно для перезапуска
-                    polling_timeout=30,  # Таймаут для каждого запроса getUpdates
-                    request_timeout=30,   # Таймаут для HTTP запросов
-                )
-                # Если polling завершился без ошибки (например, KeyboardInterrupt)
-                break
-            except KeyboardInterrupt:
-                logger.info("Бот остановлен пользователем")
-                break
-            except Exception as e:
-                error_msg = str(e)
-                consecutive_errors += 1
-                is_first_start = False  # После первой ошибки это уже не первый запуск
-
-                # Логируем ошибку
-                logger.error(f"Ошибка при работе бота (ошибка #{consecutive_errors}): {e}", exc_info=True)
-                
-                # Проверяем тип ошибки
-                is_critical = False
-                
-                # Специальная обработка различных типов ошибок
-                if "Conflict" in error_msg or "getUpdates" in error_msg:
-                    logger.warning("Обнаружен конфликт с другим экземпляром бота")
-                    logger.warning("Убедитесь, что запущен только один экземпляр бота на Render!")
-                    is_critical = True
-                elif "timeout" in error_msg.lower() or "timed out" in error_msg.lower():
-                    logger.warning("Таймаут соединения - это нормально при долгом простое")
-                    consecutive_errors = 0  # Таймауты не считаем критическими
-                elif "Connection" in error_msg or "network" in error_msg.lower():
-                    logger.warning("Проблема с сетью - переподключение...")
-                    consecutive_errors = 0  # Сетевые ошибки не критичны
-                elif consecutive_errors >= max_consecutive_errors:
-                    logger.critical(f"Слишком много последовательных ошибок ({consecutive_errors})")
-                    is_critical = True
-                
-                # Если критическая ошибка или слишком много ошибок подряд
-                if is_critical and consecutive_errors >= max_consecutive_errors:
-                    logger.error("Критическая ошибка - увеличенная задержка перед перезапуском")
-                    retry_delay = min(retry_delay * 2, 600)  # До 10 минут
+                if config.WEBHOOK_URL:
+                    await run_webhook()
                 else:
-                    # Для обычных ошибок используем стандартную задержку
-                    retry_delay = 30
-                
-                # Ждем перед перезапуском
-                logger.info(f"Перезапуск через {retry_delay} секунд...")
-                await asyncio.sleep(retry_delay)
-                
-                # Сбрасываем счетчик при успешном перезапуске
-                if consecutive_errors < max_consecutive_errors:
-                    consecutive_errors = 0
+                    await run_polling()
+            finally:
+                for task in background_tasks:
+                    task.cancel()
     finally:
-        # Останавливаем все задачи
-        cleanup_task_handle.cancel()
-        heartbeat_task_handle.cancel()
-        connection_check_handle.cancel()
-        try:
-            await cleanup_task_handle
-            await heartbeat_task_handle
-            await connection_check_handle
-        except asyncio.CancelledError:
-            pass
-        
-        # Закрываем сессию бота
+        # Сохраняем изменения, не успевшие попасть на диск
+        if GAMES_DIRTY.is_set():
+            await save_games()
+        if health_runner is not None:
+            await health_runner.cleanup()
+        # Закрываем сессию бота; при обрыве сети не ждём дольше SHUTDOWN_TIMEOUT
         try:
-            await bot.session.close()
-        except:
-            pass
+            await asyncio.wait_for(bot.session.close(), timeout=SHUTDOWN_TIMEOUT)
+        except Exception as e:
+            logger.warning(f"Не удалось корректно закрыть сессию бота: {e!r}")
         
         logger.info("Бот остановлен.")
 
@@ -11,4 +11,19 @@ if not TOKEN:
 
 BOT_TOKEN = TOKEN
 MIN_PLAYERS = int(os.getenv("MIN_PLAYERS", "3"))
-DATA_DIR = os.getenv("DATA_DIR", ".")
\ No newline at end of file
+DATA_DIR = os.getenv("DATA_DIR", ".")
+
+# Webhook режим: если WEBHOOK_URL задан (например, https://my-bot.onrender.com),
+# бот принимает обновления по HTTP вместо long polling
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Секрет, который Telegram присылает в заголовке каждого обновления: без него
+# любой, кто узнал адрес, мог бы подделывать обновления (A-Z, a-z, 0-9, _ и -)
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")
+if WEBHOOK_URL and not WEBHOOK_SECRET:
+    raise ValueError("WEBHOOK_SECRET environment variable is required when WEBHOOK_URL is set")
+
+# Render и Railway задают PORT (Render ещё и RENDER): на этом порту работает
+# health check сервер, а в режиме webhook — сервер обновлений
+PORT = int(os.getenv("PORT", "8000"))
+PLATFORM = "Render" if os.getenv("RENDER") else "Railway" if os.getenv("PORT") else None
\ No newline at end of file
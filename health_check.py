@@ -1,33 +1,38 @@
 #!/usr/bin/env python3
 """
 Простой HTTP сервер для health check'а на Render
+(aiohttp, работает в том же event loop, что и бот)
 """
+import asyncio
 import os
-from http.server import HTTPServer, BaseHTTPRequestHandler
-import threading
-import time
+from typing import Callable, Optional
 
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/health':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/plain')
-            self.end_headers()
-            self.wfile.write(b'Bot is running')
-        else:
-            self.send_response(404)
-            self.end_headers()
-    
-    def log_message(self, format, *args):
-        # Отключаем логи HTTP сервера
-        pass
+from aiohttp import web
 
-def start_health_server():
-    """Запускает HTTP сервер для health check'а"""
+def make_health_handler(is_alive: Optional[Callable[[], bool]] = None):
+    """Создаёт обработчик /health; is_alive проверяет, что бот действительно работает
+    (а не только жив процесс)"""
+    async def health_handler(request: web.Request) -> web.Response:
+        if is_alive is not None and not is_alive():
+            return web.Response(status=503, text="Bot is not responding")
+        return web.Response(text="Bot is running")
+    return health_handler
+
+async def start_health_server(port: int, is_alive: Optional[Callable[[], bool]] = None) -> web.AppRunner:
+    """Запускает HTTP сервер для health check'а в текущем event loop"""
+    app = web.Application()
+    app.router.add_get('/health', make_health_handler(is_alive))
+    # access_log=None — отключаем логи HTTP сервера
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    return runner
+
+async def serve_forever():
     port = int(os.environ.get('PORT', 8000))
-    server = HTTPServer(('0.0.0.0', port), HealthCheckHandler)
+    await start_health_server(port)
     print(f"Health check server started on port {port}")
-    server.serve_forever()
+    await asyncio.Event().wait()
 
 if __name__ == "__main__":
-    start_health_server()
+    asyncio.run(serve_forever())
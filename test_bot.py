@@ -2,18 +2,37 @@
 """
 Скрипт для тестирования бота
 """
+import contextlib
+import functools
+import importlib.util
+import io
 import os
 import sys
-import json
 from pathlib import Path
 
+ENV_FILE = Path(".env")
+
+# Значения BOT_TOKEN из примеров в документации — с ними бот не запустится
+PLACEHOLDER_TOKENS = frozenset({None, "", "your_bot_token_here", "your_actual_bot_token_here"})
+
+DATA_FILE_NAMES = ("situations.json", "witnesses.json")
+
+@functools.cache
+def load_env():
+    """Загружает .env один раз за запуск; False, если python-dotenv не установлен"""
+    try:
+        from dotenv import load_dotenv
+    except ImportError:
+        return False
+    load_dotenv()
+    return True
+
 def test_environment():
     """Проверяет переменные окружения"""
     print("🔍 Проверка переменных окружения...")
     
     # Проверяем наличие .env файла
-    env_file = Path(".env")
-    if not env_file.exists():
+    if not ENV_FILE.exists():
         print("❌ Файл .env не найден!")
         print("📝 Создайте файл .env с содержимым:")
         print("BOT_TOKEN=your_bot_token_here")
@@ -22,11 +41,12 @@ def test_environment():
         return False
     
     # Проверяем токен
-    from dotenv import load_dotenv
-    load_dotenv()
+    if not load_env():
+        print("❌ python-dotenv не установлен — .env не прочитать!")
+        return False
     
     token = os.getenv("BOT_TOKEN")
-    if not token or token == "your_bot_token_here":
+    if token in PLACEHOLDER_TOKENS:
         print("❌ Токен бота не настроен!")
         print("📝 Установите правильный токен в файле .env")
         return False
@@ -38,22 +58,27 @@ def test_data_files():
     """Проверяет файлы с данными"""
     print("\n🔍 Проверка файлов данных...")
     
-    files_to_check = ["situations.json", "witnesses.json", "conclusions.json"]
+    # бот читает данные через orjson — проверяем тем же парсером
+    try:
+        import orjson
+    except ImportError:
+        print("❌ orjson не установлен — файлы данных проверить нельзя!")
+        return False
     
-    for filename in files_to_check:
-        file_path = Path(filename)
-        if not file_path.exists():
-            print(f"❌ Файл {filename} не найден!")
-            return False
-        
+    # Ищем файлы там же, где их читает бот (DATA_DIR из .env, по умолчанию текущая папка)
+    load_env()
+    data_dir = Path(os.getenv("DATA_DIR", "."))
+    for filename in DATA_FILE_NAMES:
         try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            data = orjson.loads((data_dir / filename).read_bytes())
             if not isinstance(data, list) or len(data) == 0:
                 print(f"❌ Файл {filename} пуст или имеет неправильный формат!")
                 return False
             print(f"✅ {filename}: {len(data)} записей")
-        except json.JSONDecodeError as e:
+        except FileNotFoundError:
+            print(f"❌ Файл {filename} не найден!")
+            return False
+        except orjson.JSONDecodeError as e:
             print(f"❌ Ошибка в JSON файле {filename}: {e}")
             return False
         except Exception as e:
@@ -66,20 +91,14 @@ def test_dependencies():
     """Проверяет зависимости"""
     print("\n🔍 Проверка зависимостей...")
     
-    required_modules = ["aiogram", "aiohttp", "dotenv"]
+    required_modules = ["aiogram", "aiohttp", "dotenv", "orjson", "aiolimiter"]
     
+    # find_spec только ищет модуль, не выполняя его импорт
     for module in required_modules:
-        try:
-            if module == "dotenv":
-                import dotenv
-            elif module == "aiogram":
-                import aiogram
-            elif module == "aiohttp":
-                import aiohttp
-            print(f"✅ {module} установлен")
-        except ImportError:
+        if importlib.util.find_spec(module) is None:
             print(f"❌ {module} не установлен!")
             return False
+        print(f"✅ {module} установлен")
     
     return True
 
@@ -118,13 +137,20 @@ def main():
     
     passed = 0
     total = len(tests)
+    failed = []
     
+    # Запускаем все проверки, даже если какая-то не прошла, чтобы сразу увидеть все проблемы
     for test in tests:
-        if test():
+        # вывод теста собираем в буфер и печатаем одной записью
+        buf = io.StringIO()
+        with contextlib.redirect_stdout(buf):
+            ok = test()
+        sys.stdout.write(buf.getvalue())
+        if ok:
             passed += 1
         else:
-            print(f"\n❌ Тест не пройден!")
-            break
+            print("\n❌ Тест не пройден!")
+            failed.append(test.__doc__)
     
     print("\n" + "=" * 50)
     if passed == total:
@@ -133,6 +159,9 @@ def main():
         print("python3 bot.py")
     else:
         print(f"❌ Пройдено {passed}/{total} тестов")
+        print("Не пройдены:")
+        for doc in failed:
+            print(f"- {doc}")
         print("🔧 Исправьте ошибки перед запуском бота")
         sys.exit(1)
 